@@ -1,14 +1,15 @@
-from typing import List, Dict
-import re
-import glob
+from typing import List, Dict, Optional
 import os
 from pathlib import Path
 from dataclasses import dataclass
 import logging
-from multiprocessing import Pool
+from concurrent.futures import ProcessPoolExecutor
 import time
 import logging
 
+import pyarrow as pa
+
+from parallel_glob import parallel_glob
 from smry2parquet import smry2parquet
 
 LOGGER = logging.getLogger(__name__)
@@ -21,10 +22,7 @@ paths = ["../../webviz_testdata/reek_history_match_large/realization-*/iter-0/ec
 output_dir = Path("./output")
 output_dir.mkdir(exist_ok=True)
 
-realidxregexp = re.compile(r"realization-(\d+)")
-
-globbedpaths = [glob.glob(path) for path in paths]
-globbedpaths = sorted(list({item for sublist in globbedpaths for item in sublist}))
+REALIZATION_DIR_PREFIX = "realization-"
 
 
 @dataclass
@@ -32,41 +30,77 @@ class FileEntry:
     real: int;
     filename: str;
 
-files_to_process: List[FileEntry] = []
 
-for path in globbedpaths:
-    real = None
+def parse_realization_number(path: str) -> Optional[int]:
+    """ Returns the number of the innermost path component of the form realization-<number>,
+    or None if there is no such component
+    """
     for path_comp in reversed(path.split(os.path.sep)):
-        realmatch = re.match(realidxregexp, path_comp)
-        if realmatch:
-            real = int(realmatch.group(1))
-            files_to_process.append(FileEntry(real=real, filename=path))
-            break
+        if path_comp.startswith(REALIZATION_DIR_PREFIX):
+            real_str = path_comp[len(REALIZATION_DIR_PREFIX):]
+            if real_str.isascii() and real_str.isdigit():
+                return int(real_str)
+
+    return None
+
 
-files_to_process = sorted(files_to_process, key=lambda e: e.real)
+# Schema of the first converted file, to be reused by the following conversions.
+# Gets set in every worker process by init_worker()
+shared_schema: Optional[pa.Schema] = None
 
-# Limit number of files to process
-#files_to_process = files_to_process[1:10]
 
+def init_worker(schema: pa.Schema) -> None:
+    global shared_schema
+    shared_schema = schema
 
-def process_one_file(entry: FileEntry):
+
+def convert_one_file(entry: FileEntry, schema: Optional[pa.Schema]) -> pa.Table:
     LOGGER.info(f"real={entry.real}: {entry.filename}")
     output_filename = str(output_dir / f"summary_r{entry.real:03}.parquet")
-    smry2parquet(entry.filename, output_filename, write_extra_feather=True)
+    return smry2parquet(entry.filename, output_filename, write_extra_feather=True, schema=schema)
+
+
+def process_one_file(entry: FileEntry) -> None:
+    # Deliberately returns nothing, so no schema or table gets pickled back to the parent
+    convert_one_file(entry, shared_schema)
+
+
+# Everything below must stay inside the main guard since the worker processes will
+# re-import this module when using the spawn start method (Windows/macOS)
+if __name__ == "__main__":
+
+    # No need to sort the globbed paths, the files get sorted on realization below
+    globbedpaths = {item for path in paths for item in parallel_glob(path)}
+
+    files_to_process: List[FileEntry] = []
+
+    for path in globbedpaths:
+        real = parse_realization_number(path)
+        if real is None:
+            LOGGER.warning(f"Skipping file, could not determine realization number: {path}")
+            continue
+
+        files_to_process.append(FileEntry(real=real, filename=path))
 
+    # Include the filename in the sort key so the order is deterministic, even if there
+    # are multiple files for the same realization
+    files_to_process = sorted(files_to_process, key=lambda e: (e.real, e.filename))
 
+    # Limit number of files to process
+    #files_to_process = files_to_process[1:10]
 
-LOGGER.info("Doing BATCH conversion SMRY -> Parquet")
-start_s = time.perf_counter()
+    LOGGER.info("Doing BATCH conversion SMRY -> Parquet")
+    start_s = time.perf_counter()
 
-for entry in files_to_process:
-    process_one_file(entry)
+    # The realizations in an ensemble almost always share the same SMSPEC, so convert the
+    # first file up front and hand its schema to the workers. For the remaining files the
+    # schema and meta data will then only be rebuilt if the columns differ.
+    if files_to_process:
+        first_schema = convert_one_file(files_to_process[0], None).schema
 
-"""
-# Experiment with multiple processes
-# Significant speedups to be had here for multiple cores!!
-with Pool() as pool:
-    pool.map(process_one_file, files_to_process)
-"""
+        # Each file is converted independently and the conversion is CPU bound (ecl + Arrow),
+        # so use processes rather than threads to sidestep the GIL
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_worker, initargs=(first_schema,)) as executor:
+            list(executor.map(process_one_file, files_to_process[1:], chunksize=1))
 
-LOGGER.info(f"Conversion finished in {(time.perf_counter() - start_s):.2f}s")
+    LOGGER.info(f"Conversion finished in {(time.perf_counter() - start_s):.2f}s")
@@ -1,24 +1,55 @@
-from typing import List, Dict
+from typing import List, Dict, Iterable, Iterator, Optional
+import argparse
+import shutil
 import re
-import glob
 import os
 from pathlib import Path
 from dataclasses import dataclass
 import logging
 import time
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import Future
 
 import pyarrow as pa
 import pyarrow.feather
+import pyarrow.ipc
 import pyarrow.parquet
 import pyarrow.dataset
 import numpy as np
 
+from parallel_glob import parallel_glob
+from writer_settings import (
+    PARQUET_ROW_GROUP_SIZE,
+    PARQUET_DATA_PAGE_SIZE,
+    PARQUET_COMPRESSION,
+    PARQUET_COMPRESSION_LEVEL,
+    OUTPUT_BUFFER_SIZE,
+)
+
 
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
+# Realization numbers are small, so 16 bits is plenty for the REAL column.
+# A dictionary encoded constant column would be even smaller in memory, but the Arrow
+# IPC file format does not allow the dictionary to change between record batches.
+REAL_FIELD = pa.field("REAL", pa.int16())
+# Max number of input files being read ahead in background threads. Each one may end up
+# as a fully decoded realization in memory, so keep this small.
+READ_AHEAD_COUNT = 4
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--columns", nargs="+", help="Only include these columns in the output, default is all columns")
+parser.add_argument("--dataset", action="store_true", help="Write a parquet dataset partitioned on REAL instead of single files")
+args = parser.parse_args()
+
+# The DATE column is always needed, so make sure it is included when projecting
+selected_columns: Optional[List[str]] = args.columns
+if selected_columns is not None and "DATE" not in selected_columns:
+    selected_columns = ["DATE"] + selected_columns
+
 
 paths = ["./output/summary_r*.parquet"]
 #paths = ["./output/summary_r*.arrow"]
@@ -28,7 +59,7 @@ output_dir.mkdir(exist_ok=True)
 
 realidxregexp = re.compile(r"summary_r(\d+)")
 
-globbedpaths = [glob.glob(path) for path in paths]
+globbedpaths = [parallel_glob(path) for path in paths]
 globbedpaths = sorted(list({item for sublist in globbedpaths for item in sublist}))
 
 
@@ -45,6 +76,12 @@ for path in globbedpaths:
         realmatch = re.match(realidxregexp, path_comp)
         if realmatch:
             real = int(realmatch.group(1))
+            # The REAL column is stored as int16, refuse numbers that would overflow it
+            if real > np.iinfo(np.int16).max:
+                raise ValueError(
+                    f"Realization number {real} of {path} exceeds the max value of the "
+                    f"{REAL_FIELD.type} REAL column ({np.iinfo(np.int16).max})"
+                )
             files_to_process.append(FileEntry(real=real, filename=path))
             break
 
@@ -57,89 +94,264 @@ LOGGER.info("Doing CONCATENATION")
 start_s = time.perf_counter()
 
 
+def select_existing_columns(column_names: List[str], columns: Optional[List[str]]) -> Optional[List[str]]:
+    """ Returns the requested columns that actually exist, in the order given by column_names.
+    Returns None if all columns should be included.
+    """
+    if columns is None:
+        return None
+
+    requested = set(columns)
+    return [name for name in column_names if name in requested]
+
+
+def read_schema_for_one_real(entry: FileEntry) -> pa.Schema:
+    if Path(entry.filename).suffix == ".parquet":
+        return pa.parquet.read_schema(entry.filename)
+    else:
+        with pa.OSFile(entry.filename, "rb") as source:
+            return pa.ipc.open_file(source).schema
+
+
 def read_and_build_table_for_one_real(entry: FileEntry) -> pa.Table:
     LOGGER.info(f"real={entry.real}: {entry.filename}")
 
     start_read_s = time.perf_counter()
     if Path(entry.filename).suffix == ".parquet":
-        table = pa.parquet.read_table(entry.filename)
-        #table = pa.parquet.read_table(entry.filename, memory_map=True)
+        # Push the column projection down into the reader so that unused columns are
+        # neither read nor decoded. Going via ParquetFile lets us check which of the
+        # requested columns exist without opening the file twice.
+        # The input files are local, so memory map them rather than reading them into
+        # freshly allocated buffers.
+        parquet_file = pa.parquet.ParquetFile(entry.filename, memory_map=True, pre_buffer=True)
+        columns = select_existing_columns(parquet_file.schema_arrow.names, selected_columns)
+        table = parquet_file.read(columns=columns, use_threads=True)
         #table = pa.dataset.dataset(entry.filename, format="parquet").to_table()
     else:
-        table = pa.feather.read_table(entry.filename)
+        # Only the schema is read to find the requested columns that exist, so that the
+        # projection can be passed on to the reader and the other columns never get
+        # decompressed. For uncompressed feather files the columns will be zero-copy
+        # views into the mapped file.
+        columns = None
+        if selected_columns is not None:
+            columns = select_existing_columns(read_schema_for_one_real(entry).names, selected_columns)
+        table = pa.feather.read_table(entry.filename, columns=columns, memory_map=True)
 
     et_read_s = time.perf_counter() - start_read_s
 
-    #table = table.select(["DATE", "FOPR", "TCPU", "BWIP:28,20,13"])
-
-    table = table.add_column(1, "REAL", pa.array(np.full(table.num_rows, entry.real)))
+    table = table.add_column(1, REAL_FIELD, pa.array(np.full(table.num_rows, entry.real, dtype=np.int16)))
 
     LOGGER.info(f"read time: {et_read_s:.2f}s   table shape: {table.shape}")
 
     return table
 
 
+def read_tables_with_read_ahead(entries: Iterable[FileEntry], read_ahead_count: int) -> Iterator[pa.Table]:
+    """ Yields the tables for the specified entries in order, while reading up to
+    read_ahead_count of the following files in background threads.
+    Arrow releases the GIL while reading and decoding, so the threads do run concurrently.
+    We deliberately avoid executor.map() since it would submit all the reads up front
+    and potentially keep every table in memory.
+    """
+    # More threads than files in flight would just sit idle
+    with ThreadPoolExecutor(max_workers=read_ahead_count) as executor:
+        pending: "deque[Future]" = deque()
+        for entry in entries:
+            pending.append(executor.submit(read_and_build_table_for_one_real, entry))
+            if len(pending) >= read_ahead_count:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def build_unified_schema(schema_list: List[pa.Schema]) -> pa.Schema:
+    """ Builds a schema containing the union of the fields in all the input schemas.
+    The REAL column is inserted right after the DATE column.
+    Raises an exception if the same column has conflicting types in the input schemas.
+    """
+    unified_schema = pa.unify_schemas(schema_list)
+    return unified_schema.insert(1, REAL_FIELD)
+
+
+def align_table_to_schema(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """ Returns table with columns ordered according to the schema.
+    Columns that are missing from the table will be filled with nulls.
+    Since the schema is a union of the input schemas, the existing columns already have
+    the right type and are passed through without any copying or casting.
+    """
+    existing_column_names = set(table.column_names)
+    column_arrays = []
+    for field in schema:
+        if field.name in existing_column_names:
+            column_arrays.append(table.column(field.name))
+        else:
+            column_arrays.append(pa.chunked_array([pa.nulls(table.num_rows, type=field.type)]))
+
+    return pa.Table.from_arrays(column_arrays, schema=schema)
+
+
+# Rather than reading all the tables into memory and concatenating them, we do a first
+# pass over the schemas only, and then stream the realizations in order to the writers.
+# This way peak memory is bounded by the READ_AHEAD_COUNT realizations being read, the one
+# being aligned and the rows pending in rebatch_tables(), independent of the total number
+# of realizations.
 lap_s = time.perf_counter()
-
-table_list = []
-
-
+schema_list = []
 for entry in files_to_process:
-    table = read_and_build_table_for_one_real(entry)
-    table_list.append(table)
-
-
-"""
-#with ProcessPoolExecutor() as executor:
-with ThreadPoolExecutor() as executor:
-    futures = executor.map(read_and_build_table_for_one_real, files_to_process)
-for f in futures:
-    table_list.append(f)
-"""
-
-LOGGER.info(f"All input files read into memory in {(time.perf_counter() - lap_s):.2f}s")
-
-
-unique_column_names = set()
-for table in table_list:
-    unique_column_names.update(table.schema.names)
-LOGGER.info(f"number of unique column names: {len(unique_column_names)}")
-
-
-LOGGER.info(f"number of tables to concatenate: {len(table_list)}")
+    schema = read_schema_for_one_real(entry)
+    columns = select_existing_columns(schema.names, selected_columns)
+    if columns is not None:
+        schema = pa.schema([schema.field(name) for name in columns])
+    schema_list.append(schema)
+unified_schema = build_unified_schema(schema_list)
+LOGGER.info(f"number of unique column names: {len(unified_schema.names) - 1}")
+LOGGER.info(f"Building unified schema took {(time.perf_counter() - lap_s):.2f}s")
+
+
+def rebatch_tables(tables: Iterable[pa.Table], target_row_count: int) -> Iterator[pa.RecordBatch]:
+    """ Regroups the rows of the tables into record batches of exactly target_row_count rows,
+    except for the very last batch which may be smaller.
+    The per-realization tables are typically much smaller than a good row group, and written
+    as is they would give many small and unevenly sized row groups/record batches.
+    Incoming tables are sliced (zero-copy) at the batch boundaries, so besides the table
+    currently being consumed, less than target_row_count rows are held back, and each
+    combine step copies exactly one batch worth of rows.
+    """
+    pending: List[pa.Table] = []
+    pending_row_count = 0
+    for table in tables:
+        while pending_row_count + table.num_rows >= target_row_count:
+            take_row_count = target_row_count - pending_row_count
+            pending.append(table.slice(0, take_row_count))
+            yield from pa.concat_tables(pending).combine_chunks().to_batches(max_chunksize=target_row_count)
+
+            table = table.slice(take_row_count)
+            pending = []
+            pending_row_count = 0
+
+        if table.num_rows > 0:
+            pending.append(table)
+            pending_row_count += table.num_rows
+
+    if pending:
+        yield from pa.concat_tables(pending).combine_chunks().to_batches(max_chunksize=target_row_count)
+
+
+def write_concatenated_files(
+    tables: Iterable[pa.Table], schema: pa.Schema, parquet_filename: str, feather_filename: str
+) -> int:
+    """ Writes the tables one after the other to a single parquet file and a single
+    feather file, using uniformly sized row groups/record batches.
+    Returns the total number of rows written.
+    """
+    # Feather V2 is the Arrow IPC file format, use same compression as pa.feather.write_feather()
+    feather_options = pa.ipc.IpcWriteOptions(compression="lz4")
+
+    parquet_sink = pa.output_stream(parquet_filename, compression=None, buffer_size=OUTPUT_BUFFER_SIZE)
+    feather_sink = pa.output_stream(feather_filename, compression=None, buffer_size=OUTPUT_BUFFER_SIZE)
+
+    parquet_writer = pa.parquet.ParquetWriter(
+        parquet_sink,
+        schema,
+        compression=PARQUET_COMPRESSION,
+        compression_level=PARQUET_COMPRESSION_LEVEL,
+        data_page_size=PARQUET_DATA_PAGE_SIZE,
+        # Only REAL and DATE have few distinct values per row group and benefit from dictionary encoding
+        use_dictionary=["DATE", "REAL"],
+        # Min/max statistics let readers skip row groups when filtering, e.g. on REAL
+        write_statistics=True,
+    )
+    feather_writer = pa.ipc.new_file(feather_sink, schema, options=feather_options)
+
+    row_count = 0
+    with parquet_sink, feather_sink, parquet_writer, feather_writer:
+        for batch in rebatch_tables(tables, PARQUET_ROW_GROUP_SIZE):
+            parquet_writer.write_batch(batch, row_group_size=PARQUET_ROW_GROUP_SIZE)
+            feather_writer.write_batch(batch)
+            row_count += batch.num_rows
+
+    return row_count
+
+
+def write_partitioned_dataset(tables: Iterable[pa.Table], schema: pa.Schema, base_dir: str) -> int:
+    """ Writes the tables as a parquet dataset with hive style partitioning on REAL, that is
+    one sub directory per realization named REAL=<real>. Returns the total number of rows written.
+    Any existing dataset in base_dir is deleted first.
+    The result can be read back as one logical table, with REAL filters being resolved
+    from the directory names, using:
+        partitioning = pa.dataset.partitioning(pa.schema([REAL_FIELD]), flavor="hive")
+        pa.dataset.dataset(base_dir, format="parquet", partitioning=partitioning)
+    Just passing partitioning="hive" also works, but then REAL is inferred as int32.
+    """
+    row_count = 0
+
+    def generate_batches() -> Iterator[pa.RecordBatch]:
+        nonlocal row_count
+        for table in tables:
+            row_count += table.num_rows
+            yield from table.to_batches()
+
+    # The REAL column is stored in the directory names and not in the files themselves
+    file_options = pa.dataset.ParquetFileFormat().make_write_options(
+        compression=PARQUET_COMPRESSION,
+        compression_level=PARQUET_COMPRESSION_LEVEL,
+        data_page_size=PARQUET_DATA_PAGE_SIZE,
+        # Each partition holds a single realization, so there are no repeated values
+        # that would benefit from dictionary encoding
+        use_dictionary=False,
+        write_statistics=True,
+    )
+
+    # write_dataset() only replaces the partitions it writes, so partitions for realizations
+    # that are gone since a previous run would otherwise be left behind
+    shutil.rmtree(base_dir, ignore_errors=True)
+
+    pa.dataset.write_dataset(
+        generate_batches(),
+        base_dir,
+        schema=schema,
+        format="parquet",
+        file_options=file_options,
+        partitioning=pa.dataset.partitioning(pa.schema([REAL_FIELD]), flavor="hive"),
+        max_rows_per_group=PARQUET_ROW_GROUP_SIZE,
+        existing_data_behavior="delete_matching",
+        # Keep the rows in input order, i.e. sorted on DATE within each realization
+        preserve_order=True,
+    )
+
+    return row_count
+
+
+LOGGER.info(f"number of tables to concatenate: {len(files_to_process)}")
 
 lap_s = time.perf_counter()
 
-# Need to investigate this further
-# The default promote=False requires all schemas to be the same
-# What should really happen if the realizations have different columns?
-#combined_table = pa.concat_tables(table_list)
-combined_table = pa.concat_tables(table_list, promote=True)
-LOGGER.info(f"combined table shape: {combined_table.shape}")
-LOGGER.info(f"In-memory concatenation took {(time.perf_counter() - lap_s):.2f}s")
-
-
-lap_s = time.perf_counter()
-output_parquet_filename = str(output_dir / "concat.parquet")
-LOGGER.info(f"Writing parquet output to: {output_parquet_filename}")
-pa.parquet.write_table(combined_table, output_parquet_filename)
-LOGGER.info(f"Writing parquet took {(time.perf_counter() - lap_s):.2f}s")
-
-lap_s = time.perf_counter()
-output_feather_filename = str(output_dir / "concat.arrow")
-LOGGER.info(f"Writing feather output to: {output_feather_filename}")
-pa.feather.write_feather(combined_table, dest=output_feather_filename)
-LOGGER.info(f"Writing feather took {(time.perf_counter() - lap_s):.2f}s")
-
-# combined_table_with_combined_chunks = combined_table.combine_chunks()
-# output_feather_filename = str(output_dir / "concat_with_combined_chunks.arrow")
-# LOGGER.info(f"Writing feather output to: {output_feather_filename}")
-# pa.feather.write_feather(combined_table_with_combined_chunks, dest=output_feather_filename)
-# LOGGER.info(f"Writing feather took {(time.perf_counter() - lap_s):.2f}s")
+read_ahead_count = max(1, min(READ_AHEAD_COUNT, len(files_to_process)))
+aligned_tables = (
+    align_table_to_schema(table, unified_schema)
+    for table in read_tables_with_read_ahead(files_to_process, read_ahead_count)
+)
+
+if args.dataset:
+    output_dataset_dir = str(output_dir / "concat_dataset")
+    LOGGER.info(f"Writing partitioned parquet dataset to: {output_dataset_dir}")
+    total_row_count = write_partitioned_dataset(aligned_tables, unified_schema, output_dataset_dir)
+else:
+    output_parquet_filename = str(output_dir / "concat.parquet")
+    output_feather_filename = str(output_dir / "concat.arrow")
+    LOGGER.info(f"Writing parquet output to: {output_parquet_filename}")
+    LOGGER.info(f"Writing feather output to: {output_feather_filename}")
+    total_row_count = write_concatenated_files(
+        aligned_tables, unified_schema, output_parquet_filename, output_feather_filename
+    )
+
+LOGGER.info(f"combined table shape: {(total_row_count, len(unified_schema.names))}")
+LOGGER.info(f"Streaming concatenation took {(time.perf_counter() - lap_s):.2f}s")
 
 
 LOGGER.info(f"DONE! total time was {(time.perf_counter() - start_s):.2f}s")
 
-#df = combined_table.to_pandas(timestamp_as_object=True)
+#table = pa.parquet.read_table(str(output_dir / "concat.parquet"))
+#df = table.to_pandas(timestamp_as_object=True)
 #print(df.head())
-
@@ -0,0 +1,58 @@
+from typing import List, Optional
+import os
+import glob
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+
+
+# -------------------------------------------------------------------------
+def _has_wildcard(path_comp: str) -> bool:
+    return any(char in path_comp for char in "*?[")
+
+
+# -------------------------------------------------------------------------
+def _list_matching_subdirs(base_dir: str, wildcard_comp: str) -> List[str]:
+    """ Returns names of the sub directories in base_dir that match wildcard_comp.
+    As with glob, hidden entries are only matched if the pattern itself starts with a dot
+    """
+    include_hidden = wildcard_comp.startswith(".")
+    try:
+        with os.scandir(base_dir or os.curdir) as it:
+            return [
+                entry.name for entry in it
+                if (include_hidden or not entry.name.startswith("."))
+                and fnmatch.fnmatch(entry.name, wildcard_comp)
+                and entry.is_dir()
+            ]
+    except OSError:
+        return []
+
+
+# -------------------------------------------------------------------------
+def parallel_glob(pattern: str, max_workers: Optional[int] = None) -> List[str]:
+    """ Returns the same paths as glob.glob(), but fans out over the directories matching
+    the first wildcard component of the pattern, globbing each of them in its own thread.
+    The directory listing is dominated by waiting for the file system, typically a
+    networked project disk with thousands of realization-* directories, so threads
+    are sufficient here.
+    """
+    path_comps = pattern.split(os.path.sep)
+    wildcard_idx = next((idx for idx, comp in enumerate(path_comps) if _has_wildcard(comp)), None)
+
+    # Nothing to fan out over if there are no wildcards or only in the last component
+    if wildcard_idx is None or wildcard_idx == len(path_comps) - 1:
+        return glob.glob(pattern)
+
+    base_dir = os.path.sep.join(path_comps[:wildcard_idx])
+    if not base_dir and pattern.startswith(os.path.sep):
+        base_dir = os.path.sep
+
+    remainder = os.path.sep.join(path_comps[wildcard_idx + 1:])
+    subdir_names = _list_matching_subdirs(base_dir, path_comps[wildcard_idx])
+    # Escape the directory names since they are literal paths, not patterns
+    sub_patterns = [os.path.join(base_dir, glob.escape(name), remainder) for name in subdir_names]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        globbed_per_subdir = executor.map(glob.glob, sub_patterns)
+
+    return [path for globbed in globbed_per_subdir for path in globbed]
@@ -9,6 +9,9 @@ import pyarrow.feather
 
 INPUT_FILENAME = "output/summary.parquet"
 
+# Just select a few columns for debugging
+SELECTED_COLUMNS = ["DATE", "FOPR", "TCPU"]
+
 print("")
 print(f"INPUT_FILENAME: {INPUT_FILENAME}")
 print("")
@@ -36,14 +39,11 @@ if Path(INPUT_FILENAME).suffix == ".arrow":
     print(f"reader.stats={reader.stats}")
 
 
+# Pass the column selection on to the readers so that only the selected columns get read
 if Path(INPUT_FILENAME).suffix == ".parquet":
-    table = pa.parquet.read_table(INPUT_FILENAME)
+    table = pa.parquet.read_table(INPUT_FILENAME, columns=SELECTED_COLUMNS, use_threads=True, pre_buffer=True)
 else:
-    table = pa.feather.read_table(INPUT_FILENAME)
-
-
-# Just select a few columns for debugging
-table = table.select(["DATE", "FOPR", "TCPU"])
+    table = pa.feather.read_table(INPUT_FILENAME, columns=SELECTED_COLUMNS)
 
 
 print("===================================")
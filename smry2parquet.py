@@ -1,16 +1,38 @@
-from typing import List, Dict, Iterable, Set
+from typing import List, Dict, Iterable, Optional
 import argparse
 from pathlib import Path
 import logging
 import json
 import time
+import ctypes
 
+import numpy as np
 import pyarrow as pa
 import pyarrow.feather
 import pyarrow.parquet
 
 from ecl.summary import EclSum, EclSumKeyWordVector
 
+from writer_settings import (
+    PARQUET_ROW_GROUP_SIZE,
+    PARQUET_DATA_PAGE_SIZE,
+    PARQUET_COMPRESSION,
+    PARQUET_COMPRESSION_LEVEL,
+    OUTPUT_BUFFER_SIZE,
+)
+
+# orjson is optional, but considerably faster than the standard json module
+try:
+    import orjson
+
+    def _json_encode(obj: object) -> bytes:
+        return orjson.dumps(obj)
+
+except ImportError:
+
+    def _json_encode(obj: object) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -21,15 +43,18 @@ def _create_smry_meta_dict(eclsum: EclSum, column_names: Iterable[str]) -> Dict[
     smry_meta = {}
 
     for col_name in column_names:
+        # Look up the node once, each lookup is a call into ecl
+        node = eclsum.smspec_node(col_name)
+
         col_meta = {}
         col_meta["unit"] = eclsum.unit(col_name)
         col_meta["is_total"] = eclsum.is_total(col_name)
         col_meta["is_rate"] = eclsum.is_rate(col_name)
-        col_meta["is_historical"] = eclsum.smspec_node(col_name).is_historical()
-        col_meta["keyword"] = eclsum.smspec_node(col_name).keyword
-        col_meta["wgname"] = eclsum.smspec_node(col_name).wgname
+        col_meta["is_historical"] = node.is_historical()
+        col_meta["keyword"] = node.keyword
+        col_meta["wgname"] = node.wgname
 
-        num = eclsum.smspec_node(col_name).get_num()
+        num = node.get_num()
         if num is not None:
             col_meta["get_num"] = num
 
@@ -39,50 +64,86 @@ def _create_smry_meta_dict(eclsum: EclSum, column_names: Iterable[str]) -> Dict[
 
 
 # -------------------------------------------------------------------------
-def _load_smry_into_table(smry_filename: str) -> pa.Table:
+def _extract_all_vectors(eclsum: EclSum, kw_vector: EclSumKeyWordVector, num_rows: int) -> np.ndarray:
+    """ Extracts the values of all the keywords in kw_vector using a single bulk call into ecl.
+    Returns a 2D float64 array with one row per time step and one column per keyword.
+    """
+    # This is the same bulk extraction that EclSum.pandas_frame() uses internally.
+    # We call it directly since EclSum.pandas_frame() throws an exception if the SMRY
+    # data has timestamps beyond 2262, see: https://github.com/equinor/ecl/issues/802
+    data = np.empty((num_rows, len(kw_vector)), dtype=np.float64)
+    EclSum._init_pandas_frame(eclsum, kw_vector, data.ctypes.data_as(ctypes.POINTER(ctypes.c_double)))
+    return data
+
+
+# -------------------------------------------------------------------------
+def _build_schema(eclsum: EclSum, column_names: List[str]) -> pa.Schema:
+    """ Builds schema with a DATE column followed by the specified summary columns,
+    with the summary meta data attached per field
+    """
+    smry_meta_dict = _create_smry_meta_dict(eclsum, column_names)
+
+    # Datatypes to use for DATE column and all the numeric columns
+    dt_timestamp_ms = pa.timestamp("ms")
+    dt_float32 = pa.float32()
+
+    field_list: List[pa.Field] = []
+    field_list.append(pa.field("DATE", dt_timestamp_ms))
+    encoded_smry_meta = {colname: _json_encode(col_meta) for colname, col_meta in smry_meta_dict.items()}
+    for colname in column_names:
+        field_metadata = { b"smry_meta": encoded_smry_meta[colname]}
+        field_list.append(pa.field(colname, dt_float32, metadata=field_metadata))
+
+    return pa.schema(field_list)
+
+
+# -------------------------------------------------------------------------
+def _load_smry_into_table(smry_filename: str, schema: Optional[pa.Schema] = None) -> pa.Table:
     """
     Reads data from SMRY file into PyArrow Table.
     DATE column is stored as an Arrow timetamp with ms resolution, timestamp[ms]
     All numeric columns will be stored as 32 bit float
     Summary meta data will be attached per field/column of the table's schema under the
     'smry_meta' key
+    If a schema is specified and its columns match those of the SMRY file, it will be
+    used as is instead of building the schema and meta data from scratch
     """
 
     eclsum = EclSum(smry_filename, include_restart=False, lazy_load=False)
 
     # Unclear what the difference between these two is, but it seems that
     # EclSum.pandas_frame() internally uses EclSumKeyWordVector
-    # For now, we go via a set to prune out duplicate entries being returned by EclSumKeyWordVector,
+    # We need to prune out duplicate entries being returned by EclSumKeyWordVector,
     # see: https://github.com/equinor/ecl/issues/816#issuecomment-865881283
-    column_names: Set[str] = set(EclSumKeyWordVector(eclsum, add_keywords = True))
+    # Keep the first occurrence of each keyword so that the columns stay in SMSPEC order,
+    # and remember its index in the keyword vector for picking data later on.
+    kw_vector = EclSumKeyWordVector(eclsum, add_keywords = True)
+    column_index_of: Dict[str, int] = {}
+    for idx, keyword in enumerate(kw_vector):
+        column_index_of.setdefault(keyword, idx)
+    column_names: List[str] = list(column_index_of)
     #column_names = eclsum.keys()
 
     # Fetch the dates as a numpy array with ms resolution
     np_dates_ms = eclsum.numpy_dates
 
-    smry_meta_dict = _create_smry_meta_dict(eclsum, column_names)
-
-    # Datatypes to use for DATE column and all the numeric columns
-    dt_timestamp_ms = pa.timestamp("ms")
-    dt_float32 = pa.float32()
+    if schema is None or schema.names != ["DATE"] + column_names:
+        schema = _build_schema(eclsum, column_names)
 
-    # Build schema for the table
-    field_list: List[pa.Field] = []
-    field_list.append(pa.field("DATE", dt_timestamp_ms))
-    for colname in column_names:
-        field_metadata = { b"smry_meta": json.dumps(smry_meta_dict[colname])}
-        field_list.append(pa.field(colname, dt_float32, metadata=field_metadata))
+    # Extract all the summary vectors in one go instead of calling EclSum.numpy_vector()
+    # per column, which crosses into ecl and traverses the SMRY data once for every column
+    data = _extract_all_vectors(eclsum, kw_vector, len(np_dates_ms))
 
-    schema = pa.schema(field_list)
+    # Downcast the whole block to float32 in one pass before handing over to Arrow.
+    # Asking for column major layout makes every column a contiguous array, which Arrow
+    # can then wrap without any further allocation or cast when the table is created
+    # against the float32 schema. Rebinding data lets the float64 block go right away.
+    data = np.asfortranarray(data, dtype=np.float32)
 
-    # Now extract all the summary vectors one by one
-    # We do this through EclSum.numpy_vector() instead of EclSum.pandas_frame() since
-    # the latter throws an exception if the SMRY data has timestamps beyond 2262,
-    # see: https://github.com/equinor/ecl/issues/802
     column_arrays = [ np_dates_ms ]
 
     for colname in column_names:
-        colvector = eclsum.numpy_vector(colname)
+        colvector = data[:, column_index_of[colname]]
         column_arrays.append(colvector)
 
     table = pa.table(column_arrays, schema=schema)
@@ -91,16 +152,40 @@ def _load_smry_into_table(smry_filename: str) -> pa.Table:
 
 
 # -------------------------------------------------------------------------
-def smry2parquet(smry_filename: str, parquet_filename: str, write_extra_feather: bool) -> pa.Table:
+def _write_table_to_parquet(table: pa.Table, parquet_filename: str) -> None:
+    """ Writes table to parquet in row groups of at most PARQUET_ROW_GROUP_SIZE rows
+    """
+    with pa.output_stream(parquet_filename, compression=None, buffer_size=OUTPUT_BUFFER_SIZE) as sink:
+        with pa.parquet.ParquetWriter(
+            sink,
+            table.schema,
+            compression=PARQUET_COMPRESSION,
+            compression_level=PARQUET_COMPRESSION_LEVEL,
+            data_page_size=PARQUET_DATA_PAGE_SIZE,
+            use_dictionary=False,
+            write_statistics=True,
+        ) as writer:
+            for batch in table.to_batches(max_chunksize=PARQUET_ROW_GROUP_SIZE):
+                writer.write_batch(batch, row_group_size=PARQUET_ROW_GROUP_SIZE)
+
+
+# -------------------------------------------------------------------------
+def smry2parquet(
+    smry_filename: str, parquet_filename: str, write_extra_feather: bool, schema: Optional[pa.Schema] = None
+) -> pa.Table:
+    """ Converts SMRY file to parquet and returns the converted table.
+    The schema of a previously converted table can be passed in to skip rebuilding the
+    schema and meta data when the SMRY files share the same SMSPEC, as is typically the
+    case for the realizations in an ensemble.
+    """
     lap_s = time.perf_counter()
     LOGGER.debug(f"Reading input SMRY data from: {smry_filename}")
-    table: pa.Table = _load_smry_into_table(smry_filename)
+    table: pa.Table = _load_smry_into_table(smry_filename, schema)
     LOGGER.debug(f"Reading input took {(time.perf_counter() - lap_s):.2f}s")
 
     lap_s = time.perf_counter()
     LOGGER.debug(f"Writing parquet file to: {parquet_filename}")
-    pa.parquet.write_table(table, parquet_filename)
-    #pa.parquet.write_table(table, parquet_filename, version="2.0", compression="ZSTD")
+    _write_table_to_parquet(table, parquet_filename)
     LOGGER.debug(f"Parquet write took {(time.perf_counter() - lap_s):.2f}s")
 
     # For testing/comparison purposes, we can also write to feather/arrow
@@ -108,10 +193,13 @@ def smry2parquet(smry_filename: str, parquet_filename: str, write_extra_feather:
         lap_s = time.perf_counter()
         arrow_filename = Path(parquet_filename).with_suffix(".arrow")
         LOGGER.debug(f"Writing arrow/feather file to: {arrow_filename}")
-        pa.feather.write_feather(table, dest=arrow_filename)
+        with pa.output_stream(str(arrow_filename), compression=None, buffer_size=OUTPUT_BUFFER_SIZE) as sink:
+            pa.feather.write_feather(table, dest=sink)
         #pa.feather.write_feather(table, dest=arrow_filename, compression="zstd")
         LOGGER.debug(f"Arrow/feather write took {(time.perf_counter() - lap_s):.2f}s")
 
+    return table
+
 
 # -------------------------------------------------------------------------
 if __name__ == "__main__":
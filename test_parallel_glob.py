@@ -0,0 +1,63 @@
+import glob
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from parallel_glob import parallel_glob
+
+
+class TestParallelGlob(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.base = Path(self._tmpdir.name)
+
+        for real_dir in ["realization-0", "realization-1", "realization-[2]", ".hidden-3"]:
+            model_dir = self.base / real_dir / "iter-0" / "model"
+            model_dir.mkdir(parents=True)
+            (model_dir / f"{real_dir}.UNSMRY").touch()
+            (model_dir / "other.txt").touch()
+
+        # Plain file matching the wildcard component, must not be descended into
+        (self.base / "realization-file").touch()
+
+    def tearDown(self) -> None:
+        self._tmpdir.cleanup()
+
+    def assert_same_as_glob(self, pattern: str) -> None:
+        self.assertEqual(sorted(parallel_glob(pattern)), sorted(glob.glob(pattern)), pattern)
+
+    def test_absolute_patterns(self) -> None:
+        base = str(self.base)
+        for pattern in [
+            os.path.join(base, "realization-*", "iter-0", "model", "*.UNSMRY"),
+            os.path.join(base, "*", "iter-0", "model", "*"),
+            os.path.join(base, ".*", "iter-0", "model", "*.UNSMRY"),
+            os.path.join(base, "realization-?", "iter-*", "model", "*.UNSMRY"),
+            os.path.join(base, "realization-0", "iter-0", "model", "realization-0.UNSMRY"),
+            os.path.join(base, "*"),
+            os.path.join(base, "nonexisting", "*", "model"),
+        ]:
+            self.assert_same_as_glob(pattern)
+
+    def test_relative_patterns(self) -> None:
+        cwd = os.getcwd()
+        os.chdir(self.base)
+        try:
+            for pattern in [
+                os.path.join("realization-*", "iter-0", "model", "*.UNSMRY"),
+                os.path.join(".", "realization-*", "iter-0", "model", "*.UNSMRY"),
+            ]:
+                self.assert_same_as_glob(pattern)
+        finally:
+            os.chdir(cwd)
+
+    def test_directory_names_with_glob_characters(self) -> None:
+        pattern = os.path.join(str(self.base), "realization-*", "iter-0", "model", "*.UNSMRY")
+        found = parallel_glob(pattern)
+        self.assertEqual(len(found), 3)
+        self.assertTrue(any("realization-[2]" in path for path in found))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,13 @@
+# Settings shared by the scripts writing parquet and feather output
+
+# Max number of rows per row group when writing parquet
+PARQUET_ROW_GROUP_SIZE = 64_000
+# Target size in bytes of the data pages within each column chunk
+PARQUET_DATA_PAGE_SIZE = 1 << 20
+# The summary vectors are mostly smoothly varying floats which compress well with ZSTD,
+# and the lowest level is about as cheap as SNAPPY
+PARQUET_COMPRESSION = "zstd"
+PARQUET_COMPRESSION_LEVEL = 1
+# Size of the buffer used when writing output files, coalesces the many small writes
+# into fewer and larger ones which helps a lot on networked file systems
+OUTPUT_BUFFER_SIZE = 4 << 20